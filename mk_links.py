@@ -1,12 +1,15 @@
 #!/usr/bin/python3
 
-from sys import argv, stderr
-from os import path, remove, listdir, symlink, link, chdir, stat, makedirs
+from sys import argv, stdout, stderr
+from os import path, remove, replace, listdir, scandir, symlink, link, chdir, stat, makedirs
+from os import open as osOpen, close as osClose, unlink, O_RDONLY, O_DIRECTORY, O_CLOEXEC
 from shutil import copy
 import re
 import getopt
+from io import StringIO
+from concurrent.futures import ThreadPoolExecutor
 
-usageMess = '''[--full|-f] [--short|-s] [--fold|-F] [--addfold|-a] [--servicenames|-S] [--hardlinks|-H] [--cleanall|-c] [--help|-h] picon-defs picon-dir ...
+usageMess = '''[--full|-f] [--short|-s] [--fold|-F] [--addfold|-a] [--servicenames|-S] [--hardlinks|-H] [--symlinks|-L] [--cleanall|-c] [--help|-h] picon-defs picon-dir ...
     --full|-f          use normal full serviceref picon links
     --short|-s         use short-form serviceref picon links
                        (REFTYPE:SID:TSID:ONID:NS)
@@ -15,13 +18,17 @@ usageMess = '''[--full|-f] [--short|-s] [--fold|-F] [--addfold|-a] [--servicenam
     --allfold|-a       add a folded serviceref link for all service
                        types other than '2' and '1', otherwise like --full
     --servicenames|-S  create service name picon links
-    --hardlinks|-H     create hard picon links rather than soft links
+    --hardlinks|-H     create hard picon links rather than soft links;
+                       hard links are cheaper for the receiver to look
+                       up, but can't be stored as links in git
+    --symlinks|-L      create soft picon links (the default)
     --cleanall|-c      remove all picon links first
     --copyimages=src-picon-dir|-C src-picon-dir
                        before creating links in each picon-dir,
                        clean out its channel_picons directory and
                        copy the contents of src-picon-dir/channel_picons
-                       to picon-dir/channel_picons, with the
+                       to picon-dir/channel_picons (as hard links where
+                       the file system allows it), with the
                        side-effect of creating the path
                        picon-dir/channel_picons if it doesn't already
                        exist
@@ -48,11 +55,11 @@ class LinkMaker:
 
     CHAN_PICON_DIR = 'channel_picons'
 
-    IS_FILE = 0
-    IS_HLINK = 1
-    IS_SLINK = 2
-    IS_OTHER = 3
-    IS_ERROR = 4
+    __slots__ = (
+        'options', 'out', 'err', 'piconPath', 'linkedPiconNames', 'origPiconLinks', 'overrides',
+        'htmlHead', 'htmlTail', 'piconFiles', '_freshDir', '_servrefLines', '_dirFd',
+        '_sortedPiconNames',
+    )
 
     # Indicators of the picon source:
     # ''      Unknown (implicit)
@@ -69,9 +76,15 @@ class LinkMaker:
 
     PICON_SRCS = frozenset(('_ab', '_fv', '_gm', '_lw', '_mp', '_nine', '_rc', '_sbs', '_wp', '_ys'))
 
-    def __init__(self, piconDefsFile, piconPath, options):
+    # REFTYPE:FLAGS:STYPE:SID:TSID:ONID:..., capturing REFTYPE, STYPE, SID and ONID
+
+    SERVREF_RE = re.compile(r'(\d+):[0-9A-Fa-f]+:([0-9A-Fa-f]+):([0-9A-Fa-f]+):[0-9A-Fa-f]+:([0-9A-Fa-f]+):')
+
+    def __init__(self, piconDefsFile, piconPath, options, out=None, err=None):
 
         self.options = options
+        self.out = out or stdout
+        self.err = err or stderr
 
         if not piconPath:
             piconPath = '.'
@@ -83,11 +96,12 @@ class LinkMaker:
         else:
             piconSet = piconBase
 
-        print(piconSet + ':', file=stderr)
+        print(piconSet + ':', file=self.err)
 
         self.linkedPiconNames = set()
         self.origPiconLinks = {}
         self.overrides = set()
+        self._freshDir = False
 
         title = self.TITLES[piconSet] if piconSet in self.TITLES else piconSet
 
@@ -104,223 +118,262 @@ class LinkMaker:
         self.htmlTail = '''  </tbody>
 </table></body></html>'''
 
+        images = None
         if self.options.get("copyImages") is not None:
-            self.copyImages(self.options.get("copyImages"))
+            images = self.copyImages(self.options.get("copyImages"))
 
         try:
-            self.servrefFile = open(piconDefsFile)
+            with open(piconDefsFile) as servrefFile:
+                self._servrefLines = servrefFile.read().splitlines()
         except Exception as err:
-            print(argv[0] + ':', "Can't open service reference file", piconDefsFile, '-', str(err), file=stderr)
+            print(argv[0] + ':', "Can't open service reference file", piconDefsFile, '-', str(err), file=self.err)
             exit(1)
 
-        self._makePiconFileList()
+        self._makePiconFileList(images)
+
+        try:
+            self._dirFd = osOpen(self.piconPath, O_RDONLY | O_DIRECTORY | O_CLOEXEC)
+        except Exception as err:
+            print("Can't open link directory", self.piconPath, '-', str(err), file=self.err)
+            exit(1)
 
         self._cleanWrongLinks()
 
-    def _makePiconFileList(self):
+    def _makePiconFileList(self, images=None):
         try:
             chanDir = path.join(self.piconPath, self.CHAN_PICON_DIR)
-            self.piconFiles = {}
-            for piconName in listdir(chanDir):
-                basename, ext = path.splitext(piconName)
-                if ext != ".png":
-                    continue
-                piconPath = path.join(chanDir, piconName)
-                if path.isfile(piconPath):
-                    origIndex = basename.rfind('_')
-                    if origIndex > 0 and basename[origIndex:] in self.PICON_SRCS:
-                        piconBasename = basename[:origIndex]
-                        if piconBasename in self.piconFiles:
-                            print("Picon file for", piconBasename, "renamed from", self.piconFiles[piconBasename][0], "to", piconName, file=stderr)
-                    elif basename not in self.piconFiles:
-                        piconBasename = basename
-                    else:
-                        piconBasename = None
-                    if piconBasename:
-                        self.piconFiles[piconBasename] = (piconName, self.getLinkRef(piconPath))
+            piconFiles = self.piconFiles = {}
+            piconSrcs = self.PICON_SRCS
+            if images is None:
+                images = {}
+                with scandir(chanDir) as entries:
+                    for entry in entries:
+                        if entry.name.endswith(".png") and entry.is_file():
+                            st = entry.stat()
+                            images[entry.name] = (st.st_dev, st.st_ino)
+            for piconName, piconRef in images.items():
+                basename = piconName[:-4]
+                origIndex = basename.rfind('_')
+                if origIndex > 0 and basename[origIndex:] in piconSrcs:
+                    piconBasename = basename[:origIndex]
+                    if piconBasename in piconFiles:
+                        print("Picon file for", piconBasename, "renamed from", piconFiles[piconBasename][0], "to", piconName, file=self.err)
+                elif basename not in piconFiles:
+                    piconBasename = basename
+                else:
+                    piconBasename = None
+                if piconBasename:
+                    piconFiles[piconBasename] = (piconName, piconRef)
+            self._sortedPiconNames = sorted(fileinfo[0] for fileinfo in self.piconFiles.values())
         except Exception as err:
-            print("Can't process image directory", chanDir, '-', str(err), file=stderr)
+            print("Can't process image directory", chanDir, '-', str(err), file=self.err)
             exit(1)
 
     def _cleanWrongLinks(self):
         wrongLinks = []
         try:
             useHardLinks = self.options.get("useHardLinks", False)
-            for servRefName in (name for name in listdir(self.piconPath) if path.splitext(name)[1] == ".png"):
-                servRefPath = path.join(self.piconPath, servRefName)
-                fileType = self.refType(servRefPath)
-                if fileType in (self.IS_SLINK, self.IS_HLINK):
-                    linkRef = self.getLinkRef(servRefPath)
-                else:
-                    continue
-                if useHardLinks == (fileType == self.IS_HLINK):
-                    self.origPiconLinks[servRefName] = linkRef
-                else:
-                    wrongLinks.append(servRefName)
+            overrides = self.overrides
+            origPiconLinks = self.origPiconLinks
+            if not self._freshDir:
+                with scandir(self.piconPath) as entries:
+                    for entry in entries:
+                        servRefName = entry.name
+                        isTmpLink = servRefName.endswith(".png.tmp")
+                        if not isTmpLink and not servRefName.endswith(".png"):
+                            continue
+                        if entry.is_symlink():
+                            isHardLink = False
+                        elif entry.is_file(follow_symlinks=False):
+                            if entry.stat().st_nlink == 1:
+                                if not isTmpLink:
+                                    overrides.add(entry.path)
+                                continue
+                            isHardLink = True
+                        else:
+                            continue
+                        if isTmpLink:
+                            # Temporary link left by an interrupted run
+                            wrongLinks.append(servRefName)
+                            continue
+                        st = entry.stat()
+                        if useHardLinks == isHardLink:
+                            origPiconLinks[servRefName] = (st.st_dev, st.st_ino)
+                        else:
+                            wrongLinks.append(servRefName)
             self._clean(wrongLinks)
             if self.options.get("cleanAll"):
                 self.clean()
         except Exception as err:
-            print("Can't process link directory", self.piconPath, "to get current link list -", str(err), file=stderr)
+            print("Can't process link directory", self.piconPath, "to get current link list -", str(err), file=self.err)
             exit(1)
 
-    def refType(self, servRefPath):
-        try:
-            if path.islink(servRefPath):
-                return self.IS_SLINK
-            if path.isfile(servRefPath):
-                return self.IS_HLINK if stat(servRefPath).st_nlink > 1 else self.IS_FILE
-            return self.IS_OTHER
-        except Exception:
-            return self.IS_ERROR
-
-    def getLinkRef(self, servRefPath):
-        st = stat(servRefPath)
-        return st.st_dev, st.st_ino
-
     def isOverride(self, servRefPath):
-        if servRefPath not in self.overrides and self.refType(servRefPath) == self.IS_FILE:
-            self.overrides.add(servRefPath)
         return servRefPath in self.overrides
 
-    def makeLinks(self):
+    def _parseServRefs(self):
         full = self.options.get("full")
         short = self.options.get("short")
         addfold = self.options.get("addfold")
         fold = self.options.get("fold")
         useServiceNameLinks = self.options.get("useServiceNameLinks")
-        useHardLinks = self.options.get("useHardLinks")
-
-        piconLinks = {}
-        linksMade = 0
-        commentRe = re.compile('#.*')
+        servRefRe = self.SERVREF_RE
 
-        for line in self.servrefFile:
-            line = commentRe.sub('', line).rstrip()
+        for line in self._servrefLines:
+            line = line.partition('#')[0].rstrip()
             if not line:
                 continue
             F = line.split()
             if len(F) > 3:
-                print("Too many fields in server reference file:", line, file=stderr)
+                print("Too many fields in server reference file:", line, file=self.err)
                 continue
             if len(F) < 3:
-                print("Too few fields in server reference file:", line, file=stderr)
+                print("Too few fields in server reference file:", line, file=self.err)
                 continue
             servRef, serviceName, picon = F
-            servRefName = servRef
-            servRefParts = servRefName.split(':')[0:10]
-            servRefs = []
+            if addfold or fold:
+                servRefMatch = servRefRe.match(servRef)
+                if not servRefMatch:
+                    print("Bad service reference in server reference file:", line, file=self.err)
+                    continue
+                refType = int(servRefMatch.group(1))
+                stype = int(servRefMatch.group(2), 16)
+                sid = int(servRefMatch.group(3), 16)
+                onid = int(servRefMatch.group(4), 16)
+            servRefParts = tuple(servRef.split(':')[0:10])
+            servRefFullName = '_'.join(servRefParts) + '.png'
+            servRefNames = []
             if useServiceNameLinks:
-                servRefs.append([serviceName])
+                servRefNames.append(serviceName + '.png')
             if full or addfold:
-                servRefs.append(servRefParts)
+                servRefNames.append(servRefFullName)
             if short:
-                servRefs.append(servRefParts[0:1] + servRefParts[3:7])
-            if addfold and (int(servRefParts[0]) & ~0x0100) == 1:
-                stype = int(servRefParts[2], 16)
-                if stype not in (0x1, 0x2, 0xA):
-                    servRefPartsFold = servRefParts[:]
-                    servRefPartsFold[2] = "1"
-                    servRefs.append(servRefPartsFold)
-                # Fake up servicref 0x2 & 0xA for ABC news Radio
-                if stype in (0x2, 0xA) and int(servRefParts[5], 16) in (0x1010, 0x3201) and int(servRefParts[3], 16) & 0xF == 0xF:
-                    servRefPartsFold = servRefParts[:]
-                    servRefPartsFold[2] = "2" if stype == 0xA else "A"
-                    servRefs.append(servRefPartsFold)
-                # Fake up servicref 0x2 & 0xA for ABC news Radio
-            if fold and (int(servRefParts[0]) & ~0x0100) == 1:
-                stype = int(servRefParts[2], 16)
-                if stype not in (0x1, 0x2, 0xA):
-                    servRefPartsFold = servRefParts[:]
-                    servRefPartsFold[2] = "1"
-                servRefs.append(servRefPartsFold)
-
-            for srp in servRefs:
-                servRefName = '_'.join(srp) + '.png'
+                servRefNames.append('_'.join(servRefParts[0:1] + servRefParts[3:7]) + '.png')
+            if addfold or fold:
+                servRefNameFold = None
+                if (refType & ~0x0100) == 1:
+                    foldHead = servRefParts[:2]
+                    foldTail = servRefParts[3:]
+                    if stype not in (0x1, 0x2, 0xA):
+                        servRefNameFold = '_'.join(foldHead + ("1",) + foldTail) + '.png'
+                        if addfold:
+                            servRefNames.append(servRefNameFold)
+                    # Fake up servicref 0x2 & 0xA for ABC news Radio
+                    elif addfold and stype in (0x2, 0xA) and onid in (0x1010, 0x3201) and sid & 0xF == 0xF:
+                        servRefNames.append('_'.join(foldHead + ("2" if stype == 0xA else "A",) + foldTail) + '.png')
+                if fold:
+                    servRefNames.append(servRefNameFold or servRefFullName)
+
+            yield servRef, picon, servRefNames
+
+    def makeLinks(self):
+        useHardLinks = self.options.get("useHardLinks")
+
+        piconDir = self.piconPath
+        piconFiles = self.piconFiles
+        origPiconLinks = self.origPiconLinks
+        isOverride = self.isOverride
+        linkedPiconNames = self.linkedPiconNames
+        join = path.join
+
+        piconLinks = {}
+        reportedOverrides = set()
+        linksMade = 0
+
+        for servRef, picon, servRefNames in self._parseServRefs():
+            for servRefName in servRefNames:
 
                 if piconLinks.get(servRefName) == picon:
                     continue
 
                 if servRefName not in piconLinks:
                     linked = False
-                    servRefPath = path.join(self.piconPath, servRefName)
+                    servRefPath = join(piconDir, servRefName)
 
-                    exists = path.exists(servRefPath)
-
-                    alreadyOverridden = servRefPath in self.overrides
-                    if exists and self.isOverride(servRefPath):
-                        if not alreadyOverridden:
-                            print("Picon", picon, "over-ridden by specific servref icon", servRefName, file=stderr)
+                    if isOverride(servRefPath):
+                        if servRefPath not in reportedOverrides:
+                            reportedOverrides.add(servRefPath)
+                            print("Picon", picon, "over-ridden by specific servref icon", servRefName, file=self.err)
                         continue
 
-                    lexists = exists or path.lexists(servRefPath)
-
-                    if (not exists or lexists) and picon in self.piconFiles:
-                        piconName, piconRef = self.piconFiles[picon]
-                        piconPath = path.join(self.CHAN_PICON_DIR, piconName)
-                        if useHardLinks:
-                            piconPath = path.join(self.piconPath, piconPath)
+                    if picon in piconFiles:
+                        piconName, piconRef = piconFiles[picon]
+                        piconPath = join(self.CHAN_PICON_DIR, piconName)
 
-                        if servRefName in self.origPiconLinks:
-                            if self.origPiconLinks[servRefName] == piconRef:
+                        if servRefName in origPiconLinks:
+                            if origPiconLinks[servRefName] == piconRef:
                                 linked = True
-                            del self.origPiconLinks[servRefName]
+                            del origPiconLinks[servRefName]
 
                         if not linked:
                             try:
-                                if lexists:
-                                    remove(servRefPath)
-
                                 linksMade += 1
-                                if useHardLinks:
-                                    link(piconPath, servRefPath)
-                                else:
-                                    symlink(piconPath, servRefPath)
+                                self._replaceLink(piconPath, servRefName, useHardLinks)
                                 linked = True
                             except Exception as err:
-                                print(("Link" if useHardLinks else "Symlink"), piconName, "->", servRefName, "failed -", str(err), file=stderr)
+                                print(("Link" if useHardLinks else "Symlink"), piconName, "->", servRefName, "failed -", str(err), file=self.err)
 
                     if linked:
-                        self.linkedPiconNames.add(piconName)
+                        linkedPiconNames.add(piconName)
                         piconLinks[servRefName] = picon
                     else:
                         if picon not in ("tba", "tobeadvised"):
-                            print("No picon", picon, "for", servRef, file=stderr)
+                            print("No picon", picon, "for", servRef, file=self.err)
                 else:
-                    print("Servref link", servRef, "->", piconLinks[servRefName], "exists; new link requested for", picon, file=stderr)
-        self.servrefFile.close()
-        print("linksMade:", linksMade, file=stderr)
+                    print("Servref link", servRef, "->", piconLinks[servRefName], "exists; new link requested for", picon, file=self.err)
+        print("linksMade:", linksMade, file=self.err)
+
+    def _makeLink(self, piconPath, linkName, useHardLinks):
+        if useHardLinks:
+            link(piconPath, linkName, src_dir_fd=self._dirFd, dst_dir_fd=self._dirFd)
+        else:
+            symlink(piconPath, linkName, dir_fd=self._dirFd)
+
+    def _replaceLink(self, piconPath, servRefName, useHardLinks):
+        try:
+            self._makeLink(piconPath, servRefName, useHardLinks)
+            return
+        except FileExistsError:
+            pass
+        tmpName = servRefName + '.tmp'
+        self._makeLink(piconPath, tmpName, useHardLinks)
+        try:
+            replace(tmpName, servRefName, src_dir_fd=self._dirFd, dst_dir_fd=self._dirFd)
+        except Exception:
+            unlink(tmpName, dir_fd=self._dirFd)
+            raise
+        if useHardLinks:
+            # rename() does nothing if both names are already links to
+            # the same file, so the temporary name may still be there
+            try:
+                unlink(tmpName, dir_fd=self._dirFd)
+            except FileNotFoundError:
+                pass
 
     def checkUnused(self):
-        piconNames = set(fileinfo[0] for fileinfo in self.piconFiles.values())
-        for piconName in sorted(piconNames - self.linkedPiconNames):
-            print("Picon", piconName, "unused", file=stderr)
+        linkedPiconNames = self.linkedPiconNames
+        for piconName in self._sortedPiconNames:
+            if piconName not in linkedPiconNames:
+                print("Picon", piconName, "unused", file=self.err)
 
     def makeHtmlIndex(self, index):
         try:
             htmlFile = open(path.join(self.piconPath, "index.html"), 'w')
         except Exception as err:
-            print("Can't write to index.html -", str(err), file=stderr)
+            print("Can't write to index.html -", str(err), file=self.err)
             exit(1)
 
-        print(self.htmlHead, file=htmlFile)
-        row = 0
-        item = 0
-        for piconName in sorted(fileinfo[0] for fileinfo in self.piconFiles.values()):
-            piconPath = path.join(self.CHAN_PICON_DIR, piconName)
-            if item == 0:
-                htmlFile.write("  ")
-                if row != 0:
-                    htmlFile.write("</tr>")
-                print("<tr>", file=htmlFile)
-            print('    <td><img src="' + piconPath + '"></td>', file=htmlFile)
-            item += 1
-            if item >= 6:
-                row += 1
-                item = 0
-        if row != 0:
-            print("  </tr>", file=htmlFile)
-        print(self.htmlTail, file=htmlFile)
+        parts = [self.htmlHead, "\n"]
+        piconNames = self._sortedPiconNames
+        for item, piconName in enumerate(piconNames):
+            if item % 6 == 0:
+                parts.append("  </tr><tr>\n" if item else "  <tr>\n")
+            parts.append('    <td><img src="' + path.join(self.CHAN_PICON_DIR, piconName) + '"></td>\n')
+        if len(piconNames) >= 6:
+            parts.append("  </tr>\n")
+        parts.append(self.htmlTail)
+        parts.append("\n")
+        htmlFile.write(''.join(parts))
         htmlFile.close()
 
     def copyImages(self, fromPath):
@@ -334,39 +387,57 @@ class LinkMaker:
                         try:
                             remove(imagePath)
                         except Exception as err:
-                            print("Can't remove", imagePath, "-", str(err), file=stderr)
+                            print("Can't remove", imagePath, "-", str(err), file=self.err)
                             exit(1)
                 except Exception as err:
-                    print("Can't access", chanPath, "-", str(err), file=stderr)
+                    print("Can't access", chanPath, "-", str(err), file=self.err)
                     exit(1)
         else:
+            self._freshDir = not path.exists(self.piconPath)
             try:
                 makedirs(chanPath, 0o755)
             except Exception as err:
-                print("Can't create", chanPath, "-", str(err), file=stderr)
+                print("Can't create", chanPath, "-", str(err), file=self.err)
                 exit(1)
 
+        images = {}
         try:
-            for imageName in (name for name in listdir(fromPath) if path.splitext(name)[1] == ".png"):
-                imageFromPath = path.join(fromPath, imageName)
-                copy(imageFromPath, chanPath)
+            with scandir(fromPath) as entries:
+                for entry in entries:
+                    imageName = entry.name
+                    if not imageName.endswith(".png"):
+                        continue
+                    imageFromPath = entry.path
+                    imagePath = path.join(chanPath, imageName)
+                    try:
+                        link(imageFromPath, imagePath)
+                        st = entry.stat()
+                    except OSError:
+                        copy(imageFromPath, chanPath)
+                        st = stat(imagePath)
+                    images[imageName] = (st.st_dev, st.st_ino)
         except Exception as err:
-            print("Can't copy", imageFromPath, "to", chanPath, "-", str(err), file=stderr)
+            print("Can't copy", imageFromPath, "to", chanPath, "-", str(err), file=self.err)
             exit(1)
+        return images
 
     def _clean(self, servRefNames):
-        print("removing:", len(servRefNames))
+        print("removing:", len(servRefNames), file=self.out)
+        if not servRefNames:
+            return
         for servRefName in servRefNames:
-            servRefPath = path.join(self.piconPath, servRefName)
             try:
-                remove(servRefPath)
+                unlink(servRefName, dir_fd=self._dirFd)
             except Exception as err:
-                print("Can't remove", servRefPath, "-", str(err), file=stderr)
+                print("Can't remove", path.join(self.piconPath, servRefName), "-", str(err), file=self.err)
 
     def clean(self):
         self._clean(self.origPiconLinks)
         self.origPiconLinks = {}
 
+    def close(self):
+        osClose(self._dirFd)
+
 
 options = {
     "full": False,
@@ -380,7 +451,7 @@ options = {
 }
 
 try:
-    opts, args = getopt.getopt(argv[1:], "fsFaSHhcC:", ["full", "short", "fold", "addfold", "servicenames", "hardlinks", "cleanall", "copyimages=", "help"])
+    opts, args = getopt.getopt(argv[1:], "fsFaSHLhcC:", ["full", "short", "fold", "addfold", "servicenames", "hardlinks", "symlinks", "cleanall", "copyimages=", "help"])
 except getopt.GetoptError as err:
     print(str(err))
     usage(2)
@@ -398,6 +469,8 @@ for o, a in opts:
         options["useServiceNameLinks"] = True
     elif o in ("--hardlinks", "-H"):
         options["useHardLinks"] = True
+    elif o in ("--symlinks", "-L"):
+        options["useHardLinks"] = False
     elif o in ("--cleanall", "-c"):
         options["cleanAll"] = True
     elif o in ("--copyimages", "-C"):
@@ -419,12 +492,40 @@ if len(args) < 2:
 
 piconDefsFile = args[0]
 
-for i in range(1, len(args)):
-    piconPath = args[i]
 
-    linkMaker = LinkMaker(piconDefsFile, piconPath, options)
+def makePiconLinks(piconPath, out=None, err=None):
+    linkMaker = LinkMaker(piconDefsFile, piconPath, options, out, err)
 
     linkMaker.makeLinks()
     linkMaker.checkUnused()
     linkMaker.makeHtmlIndex('index.html')
     linkMaker.clean()
+    linkMaker.close()
+
+
+def makeBufferedPiconLinks(piconPath):
+    out = StringIO()
+    err = StringIO()
+    try:
+        makePiconLinks(piconPath, out, err)
+    except BaseException as exc:
+        return out, err, exc
+    return out, err, None
+
+
+piconPaths = args[1:]
+
+if len(piconPaths) == 1:
+    makePiconLinks(piconPaths[0])
+else:
+    # The picon-dirs are independent, so process them in parallel, but
+    # report each one's messages together and in command-line order
+    firstExc = None
+    with ThreadPoolExecutor(max_workers=min(8, len(piconPaths))) as executor:
+        for out, err, exc in executor.map(makeBufferedPiconLinks, piconPaths):
+            stdout.write(out.getvalue())
+            stderr.write(err.getvalue())
+            if firstExc is None:
+                firstExc = exc
+    if firstExc is not None:
+        raise firstExc